@@ -6,17 +6,39 @@ from flask import Flask, render_template, request, jsonify, send_file
 from camera_utils import CameraCapture
 from detector import QualityDetector
 from models import Database
+from evidence_store import EvidenceStore
 import os
 from datetime import datetime
 import json
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+# 检测图像保留天数（None表示永久保留）与压缩策略
+app.config['EVIDENCE_RETENTION_DAYS'] = {'Passed': 30, 'Failed': 365}
+app.config['EVIDENCE_COMPACT_AFTER_DAYS'] = {'Passed': 1, 'Failed': None}
+app.config['EVIDENCE_COMPACTION_MODE'] = 'archive'
+app.config['EVIDENCE_COMPACTION_INTERVAL'] = 3600
 
 # 初始化组件
 camera = CameraCapture()
 detector = QualityDetector()
 db = Database()
+evidence_store = EvidenceStore(
+    db,
+    root='static/images',
+    retention_days=app.config['EVIDENCE_RETENTION_DAYS'],
+    compact_after_days=app.config['EVIDENCE_COMPACT_AFTER_DAYS'],
+    compaction_mode=app.config['EVIDENCE_COMPACTION_MODE']
+)
+
+def start_evidence_compaction(debug):
+    """启动后台图像压缩线程（调试重载模式下只在子进程中启动，避免重复运行）"""
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        evidence_store.start_background_compaction(app.config['EVIDENCE_COMPACTION_INTERVAL'])
+
+# 由WSGI服务器或flask run导入时启动（多个工作进程通过数据库租约保证同一时间只有一个在压缩）
+if __name__ != '__main__':
+    start_evidence_compaction(app.debug)
 
 # 创建必要的目录
 os.makedirs('static/images', exist_ok=True)
@@ -90,18 +112,19 @@ def detect_quality():
         # 执行检测
         result = detector.detect_defects(image)
         
-        # 保存图像（可选）
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        image_filename = f'static/images/detection_{timestamp}.jpg'
-        image.save(image_filename)
+        # 保存图像（按日期分目录存储）
+        timestamp = datetime.now()
+        image_path, image_size = evidence_store.save(image, timestamp)
         
         # Save detection record
         record_id = db.add_record(
             result='Passed' if result['qualified'] else 'Failed',
             confidence=result['confidence'],
-            image_path=image_filename,
+            image_path=image_path,
             defect_type=result['defect_type'],
-            quality_score=result['quality_score']
+            quality_score=result['quality_score'],
+            image_size=image_size,
+            timestamp=timestamp
         )
         
         # 将result转换为可JSON序列化的格式
@@ -157,13 +180,46 @@ def get_records():
                 'result': record[2],
                 'confidence': record[3],
                 'defect_type': record[4],
-                'quality_score': record[5]
+                'quality_score': record[5],
+                'storage_state': record[6]
             })
         
         return jsonify({'success': True, 'data': records_list})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
 
+@app.route('/api/records/<int:record_id>/image', methods=['GET'])
+def get_record_image(record_id):
+    """获取检测记录的图像（原图、缩略图或归档中的缩略图）"""
+    try:
+        record = db.get_record_image(record_id)
+        if record is None or record[1] not in ('full', 'thumbnail', 'archived'):
+            return jsonify({'success': False, 'message': 'Image not available'}), 404
+        
+        image_path, _, archive_member = record
+        image_bytes = evidence_store.read_image(image_path, archive_member)
+        
+        import io
+        return send_file(io.BytesIO(image_bytes), mimetype='image/jpeg')
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+@app.route('/api/storage', methods=['GET'])
+def get_storage():
+    """获取检测图像存储占用"""
+    try:
+        return jsonify({'success': True, 'data': db.get_storage_usage()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+@app.route('/api/storage/compact', methods=['POST'])
+def compact_storage():
+    """立即执行图像压缩与过期清理"""
+    try:
+        return jsonify({'success': True, 'data': evidence_store.run_maintenance()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
 if __name__ == '__main__':
     print("=" * 50)
     print("Industrial Product Quality Detection System")
@@ -171,5 +227,6 @@ if __name__ == '__main__':
     print("Starting server...")
     print("Please access in browser: http://localhost:5000")
     print("=" * 50)
+    start_evidence_compaction(debug=True)
     app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,296 @@
+"""
+Evidence Image Storage
+Date-sharded image files with per-verdict retention and background compaction
+"""
+from datetime import datetime, timedelta
+from PIL import Image
+import io
+import os
+import tempfile
+import threading
+import uuid
+import zipfile
+
+# Detection results stored for each verdict (old Chinese values kept for compatibility)
+VERDICT_RESULTS = {
+    'Passed': ('Passed', '合格'),
+    'Failed': ('Failed', '不合格'),
+}
+
+COMPACTION_MODES = ('thumbnail', 'archive')
+
+# Database lease that keeps maintenance to one process when several workers share the store
+MAINTENANCE_LEASE = 'evidence_maintenance'
+
+
+class EvidenceStore:
+    def __init__(self, db, root='static/images', retention_days=None, compact_after_days=None,
+                 compaction_mode='archive', thumbnail_size=(160, 120), thumbnail_quality=70,
+                 max_records_per_pass=1000, archive_batch_size=200, lease_seconds=1800):
+        """
+        retention_days: verdict -> days to keep the image (None keeps it forever)
+        compact_after_days: verdict -> days before the image is shrunk (None never compacts)
+        compaction_mode: 'thumbnail' rewrites the file in place,
+                         'archive' packs thumbnails into one zip file per day and verdict
+        max_records_per_pass: rows handled by one compaction or retention pass
+        archive_batch_size: thumbnails held in memory before they are written to their archive
+        lease_seconds: how long a maintenance pass may run before another process can take over
+        """
+        if compaction_mode not in COMPACTION_MODES:
+            raise ValueError(f'Unknown compaction mode: {compaction_mode}')
+
+        self.db = db
+        self.root = root.rstrip('/')
+        self.retention_days = retention_days if retention_days is not None else {'Passed': 30, 'Failed': 365}
+        self.compact_after_days = compact_after_days if compact_after_days is not None else {'Passed': 1}
+        self.compaction_mode = compaction_mode
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_quality = thumbnail_quality
+        self.max_records_per_pass = max_records_per_pass
+        self.archive_batch_size = archive_batch_size
+        self.lease_seconds = lease_seconds
+
+        self._lock = threading.Lock()
+        self._lease_owner = uuid.uuid4().hex
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        os.makedirs(self.root, exist_ok=True)
+
+    def save(self, image, timestamp):
+        """Save a detection image into its date shard, return (image_path, image_size)"""
+        shard = timestamp.strftime('%Y/%m/%d')
+        os.makedirs(f'{self.root}/{shard}', exist_ok=True)
+
+        image_path = f"{self.root}/{shard}/detection_{timestamp.strftime('%H%M%S_%f')}.jpg"
+        image.save(image_path)
+
+        return image_path, os.path.getsize(image_path)
+
+    def compact(self, now=None):
+        """Shrink full-size images older than the verdict's compaction age, return count"""
+        now = now or datetime.now()
+        compacted = 0
+        remaining = self.max_records_per_pass
+
+        for verdict, days in self.compact_after_days.items():
+            if days is None or remaining <= 0:
+                continue
+            cutoff = now - timedelta(days=days)
+            records = self.db.get_stored_images(VERDICT_RESULTS[verdict], ('full',), cutoff, remaining)
+            remaining -= len(records)
+            # Thumbnails waiting to be written to the archive currently being filled
+            archive_path, batch = None, []
+
+            for record_id, timestamp, _, image_path, image_size, _, _ in records:
+                try:
+                    thumbnail = self._make_thumbnail(image_path)
+                except FileNotFoundError:
+                    self.db.update_image_storage(record_id, None, None, 'missing')
+                    continue
+                except (OSError, Image.UnidentifiedImageError):
+                    # Truncated or unreadable file; keep it for retention but stop retrying
+                    self.db.update_image_storage(record_id, image_path, image_size, 'corrupt')
+                    continue
+
+                if self.compaction_mode == 'archive':
+                    next_archive_path = self._archive_path(timestamp, verdict)
+                    # Rows come in timestamp order, so an archive is complete once the day changes
+                    if batch and (next_archive_path != archive_path or len(batch) >= self.archive_batch_size):
+                        compacted += self._flush_archive(archive_path, batch)
+                        batch = []
+                    archive_path = next_archive_path
+                    batch.append((record_id, image_path, thumbnail))
+                else:
+                    try:
+                        self._replace_file(image_path, lambda f: f.write(thumbnail))
+                    except OSError as e:
+                        # Record stays 'full' and is retried on the next pass
+                        print(f"Failed to compact {image_path}: {e}")
+                        continue
+                    self.db.update_image_storage(record_id, image_path, len(thumbnail), 'thumbnail')
+                    compacted += 1
+
+            if batch:
+                compacted += self._flush_archive(archive_path, batch)
+
+        return compacted
+
+    def purge_expired(self, now=None):
+        """Delete images older than the verdict's retention period, return count"""
+        now = now or datetime.now()
+        purged = 0
+        remaining = self.max_records_per_pass
+
+        for verdict, days in self.retention_days.items():
+            if days is None or remaining <= 0:
+                continue
+            cutoff = now - timedelta(days=days)
+            records = self.db.get_stored_images(VERDICT_RESULTS[verdict],
+                                                ('full', 'thumbnail', 'archived', 'corrupt'), cutoff, remaining)
+            remaining -= len(records)
+
+            # archive_path -> [(record_id, archive_member)]
+            expired_archives = {}
+
+            for record_id, _, _, image_path, _, storage_state, archive_member in records:
+                if storage_state == 'archived':
+                    expired_archives.setdefault(image_path, []).append((record_id, archive_member))
+                    continue
+                try:
+                    os.remove(image_path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # Record keeps its state so the file is retried on the next pass
+                    print(f"Failed to remove {image_path}: {e}")
+                    continue
+                self.db.update_image_storage(record_id, None, None, 'deleted')
+                purged += 1
+
+            for archive_path, expired in expired_archives.items():
+                purged += self._purge_archive(archive_path, expired)
+
+        return purged
+
+    def run_maintenance(self, now=None):
+        """Run one retention and compaction pass"""
+        with self._lock:
+            if not self.db.acquire_lease(MAINTENANCE_LEASE, self._lease_owner, self.lease_seconds):
+                # Another process is already running maintenance on this store
+                return {'purged': 0, 'compacted': 0, 'skipped': True}
+            try:
+                # Purge first so expired images are not compacted only to be deleted
+                results = {'purged': self.purge_expired(now), 'compacted': 0, 'skipped': False}
+                try:
+                    results['compacted'] = self.compact(now)
+                except Exception as e:
+                    print(f"Evidence compaction failed: {e}")
+                return results
+            finally:
+                self.db.release_lease(MAINTENANCE_LEASE, self._lease_owner)
+
+    def start_background_compaction(self, interval_seconds=3600):
+        """Start a daemon thread that runs maintenance periodically"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._maintenance_loop, args=(interval_seconds,),
+                                        name='evidence-compaction', daemon=True)
+        self._thread.start()
+
+    def stop_background_compaction(self):
+        """Stop the maintenance thread"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def read_image(self, image_path, archive_member=None):
+        """Read stored image bytes, from a loose file or an archive"""
+        if archive_member:
+            with zipfile.ZipFile(image_path) as archive:
+                return archive.read(archive_member)
+        with open(image_path, 'rb') as f:
+            return f.read()
+
+    def _maintenance_loop(self, interval_seconds):
+        while not self._stop_event.is_set():
+            try:
+                self.run_maintenance()
+            except Exception as e:
+                print(f"Evidence compaction failed: {e}")
+            self._stop_event.wait(interval_seconds)
+
+    def _remove_quietly(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _make_thumbnail(self, image_path):
+        with Image.open(image_path) as image:
+            image = image.convert('RGB')
+            image.thumbnail(self.thumbnail_size)
+            buffered = io.BytesIO()
+            image.save(buffered, format='JPEG', quality=self.thumbnail_quality)
+        return buffered.getvalue()
+
+    def _purge_archive(self, archive_path, expired):
+        """Drop expired members from a shared archive, or remove it once none are left"""
+        keep = set(self.db.get_archive_members(archive_path)) - {member for _, member in expired}
+        try:
+            if keep:
+                self._write_archive(archive_path, keep, [])
+            else:
+                os.remove(archive_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Records stay 'archived' so the archive is retried on the next pass
+            print(f"Failed to purge archive {archive_path}: {e}")
+            return 0
+
+        for record_id, _ in expired:
+            self.db.update_image_storage(record_id, None, None, 'deleted')
+        return len(expired)
+
+    def _flush_archive(self, archive_path, entries):
+        """Write a batch of thumbnails to their archive and record it, return count"""
+        try:
+            self._write_archive(archive_path, set(self.db.get_archive_members(archive_path)), entries)
+        except OSError as e:
+            print(f"Failed to write archive {archive_path}: {e}")
+            return 0
+
+        compacted = 0
+        for record_id, image_path, thumbnail in entries:
+            try:
+                os.remove(image_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Record stays 'full'; its archived copy is replaced on the next pass
+                print(f"Failed to remove {image_path}: {e}")
+                continue
+            self.db.update_image_storage(record_id, archive_path, len(thumbnail), 'archived',
+                                         os.path.basename(image_path))
+            compacted += 1
+
+        return compacted
+
+    def _write_archive(self, archive_path, keep, entries):
+        """Rewrite an archive with only the kept members plus new ones, replacing it in one step"""
+        members = {os.path.basename(image_path): thumbnail for _, image_path, thumbnail in entries}
+
+        def write(f):
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as new_archive:
+                if os.path.exists(archive_path):
+                    with zipfile.ZipFile(archive_path) as old_archive:
+                        for name in old_archive.namelist():
+                            # Expired members and leftovers from an interrupted pass are dropped
+                            if name in keep and name not in members:
+                                new_archive.writestr(name, old_archive.read(name))
+                for name, thumbnail in members.items():
+                    new_archive.writestr(name, thumbnail)
+
+        self._replace_file(archive_path, write)
+
+    def _replace_file(self, path, write):
+        """Write a file through a unique temp file next to it and swap it into place"""
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            self._remove_quietly(temp_path)
+            raise
+
+    def _archive_path(self, timestamp, verdict):
+        # Record timestamps are stored as 'YYYY-MM-DD HH:MM:SS'
+        day = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        shard = day.strftime('%Y/%m/%d')
+        os.makedirs(f'{self.root}/{shard}', exist_ok=True)
+        return f'{self.root}/{shard}/{verdict.lower()}_pack.zip'
@@ -4,6 +4,7 @@ Database Model Definitions
 from datetime import datetime
 import sqlite3
 import os
+import time
 
 class Database:
     def __init__(self, db_path='quality_detection.db'):
@@ -23,25 +24,93 @@ class Database:
                 confidence REAL,
                 image_path TEXT,
                 defect_type TEXT,
-                quality_score REAL
+                quality_score REAL,
+                image_size INTEGER,
+                storage_state TEXT,
+                archive_member TEXT
+            )
+        ''')
+        
+        # Upgrade databases created before evidence storage tracking
+        cursor.execute('PRAGMA table_info(detection_records)')
+        columns = {row[1] for row in cursor.fetchall()}
+        for column, column_type in (('image_size', 'INTEGER'),
+                                    ('storage_state', 'TEXT'),
+                                    ('archive_member', 'TEXT')):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE detection_records ADD COLUMN {column} {column_type}')
+        # Backfill images saved before tracking (runs once per legacy row): move them from the
+        # flat image folder into their date shard and record their size and state
+        cursor.execute('''
+            SELECT id, timestamp, image_path FROM detection_records
+            WHERE storage_state IS NULL AND image_path IS NOT NULL
+        ''')
+        for record_id, timestamp, image_path in cursor.fetchall():
+            image_path = self._shard_legacy_image(image_path, timestamp)
+            if os.path.exists(image_path):
+                image_size, storage_state = os.path.getsize(image_path), 'full'
+            else:
+                image_size, storage_state = None, 'missing'
+            cursor.execute('''
+                UPDATE detection_records SET image_path = ?, image_size = ?, storage_state = ?
+                WHERE id = ?
+            ''', (image_path, image_size, storage_state, record_id))
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_detection_records_storage
+            ON detection_records (storage_state, result, timestamp)
+        ''')
+        
+        # Leases let one process at a time run background jobs such as evidence compaction
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL NOT NULL
             )
         ''')
         
         conn.commit()
         conn.close()
     
-    def add_record(self, result, confidence, image_path=None, defect_type=None, quality_score=None):
+    def _shard_legacy_image(self, image_path, timestamp):
+        """Move a legacy image into its YYYY/MM/DD folder, return its current path"""
+        try:
+            shard = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').strftime('%Y/%m/%d')
+        except ValueError:
+            return image_path
+        
+        folder, filename = os.path.split(image_path)
+        sharded_path = f'{folder}/{shard}/{filename}' if folder else f'{shard}/{filename}'
+        if os.path.exists(image_path):
+            try:
+                os.makedirs(os.path.dirname(sharded_path), exist_ok=True)
+                os.replace(image_path, sharded_path)
+            except OSError as e:
+                print(f"Failed to move {image_path}: {e}")
+                return image_path
+        elif not os.path.exists(sharded_path):
+            return image_path
+        # Either moved now or by an earlier upgrade that stopped before committing
+        return sharded_path
+    
+    def add_record(self, result, confidence, image_path=None, defect_type=None, quality_score=None,
+                   image_size=None, timestamp=None):
         """Add detection record"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if timestamp is None:
+            timestamp = datetime.now()
+        timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        storage_state = 'full' if image_path else None
         
         cursor.execute('''
             INSERT INTO detection_records 
-            (timestamp, result, confidence, image_path, defect_type, quality_score)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (timestamp, result, confidence, image_path, defect_type, quality_score))
+            (timestamp, result, confidence, image_path, defect_type, quality_score,
+             image_size, storage_state)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (timestamp, result, confidence, image_path, defect_type, quality_score,
+              image_size, storage_state))
         
         conn.commit()
         record_id = cursor.lastrowid
@@ -55,7 +124,7 @@ class Database:
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT id, timestamp, result, confidence, defect_type, quality_score
+            SELECT id, timestamp, result, confidence, defect_type, quality_score, storage_state
             FROM detection_records
             ORDER BY timestamp DESC
             LIMIT ?
@@ -66,6 +135,121 @@ class Database:
         
         return records
     
+    def get_record_image(self, record_id):
+        """Get image location of a detection record"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT image_path, storage_state, archive_member
+            FROM detection_records
+            WHERE id = ?
+        ''', (record_id,))
+        
+        record = cursor.fetchone()
+        conn.close()
+        
+        return record
+    
+    def get_stored_images(self, results, states, before, limit=None):
+        """Get records whose evidence image is in one of the given states and older than a cutoff"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        result_marks = ', '.join('?' * len(results))
+        state_marks = ', '.join('?' * len(states))
+        cursor.execute(f'''
+            SELECT id, timestamp, result, image_path, image_size, storage_state, archive_member
+            FROM detection_records
+            WHERE result IN ({result_marks}) AND storage_state IN ({state_marks})
+              AND timestamp < ?
+            ORDER BY timestamp
+            LIMIT ?
+        ''', (*results, *states, before.strftime('%Y-%m-%d %H:%M:%S'), -1 if limit is None else limit))
+        
+        records = cursor.fetchall()
+        conn.close()
+        
+        return records
+    
+    def update_image_storage(self, record_id, image_path, image_size, storage_state, archive_member=None):
+        """Update where and how a record's evidence image is stored"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE detection_records
+            SET image_path = ?, image_size = ?, storage_state = ?, archive_member = ?
+            WHERE id = ?
+        ''', (image_path, image_size, storage_state, archive_member, record_id))
+        
+        conn.commit()
+        conn.close()
+    
+    def acquire_lease(self, name, owner, seconds):
+        """Take or renew a named lease, return True if owner now holds it"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        now = time.time()
+        cursor.execute('''
+            INSERT OR IGNORE INTO maintenance_leases (name, owner, expires_at)
+            VALUES (?, NULL, 0)
+        ''', (name,))
+        cursor.execute('''
+            UPDATE maintenance_leases SET owner = ?, expires_at = ?
+            WHERE name = ? AND (owner IS NULL OR owner = ? OR expires_at < ?)
+        ''', (owner, now + seconds, name, owner, now))
+        acquired = cursor.rowcount == 1
+        
+        conn.commit()
+        conn.close()
+        
+        return acquired
+    
+    def release_lease(self, name, owner):
+        """Release a lease held by owner"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE maintenance_leases SET owner = NULL, expires_at = 0
+            WHERE name = ? AND owner = ?
+        ''', (name, owner))
+        
+        conn.commit()
+        conn.close()
+    
+    def get_archive_members(self, archive_path):
+        """Get member names of records that still keep their evidence image in an archive"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT archive_member FROM detection_records
+            WHERE image_path = ? AND storage_state = 'archived'
+        ''', (archive_path,))
+        members = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        
+        return members
+    
+    def get_storage_usage(self):
+        """Get evidence image count and size grouped by storage state"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT storage_state, COUNT(*), COALESCE(SUM(image_size), 0)
+            FROM detection_records
+            WHERE storage_state IS NOT NULL
+            GROUP BY storage_state
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return {state: {'count': count, 'bytes': size} for state, count, size in rows}
+    
     def get_statistics(self):
         """Get statistics"""
         conn = sqlite3.connect(self.db_path)
@@ -0,0 +1,141 @@
+"""
+Evidence storage tests
+"""
+from datetime import datetime, timedelta
+import glob
+import os
+import sqlite3
+import zipfile
+
+from PIL import Image
+import pytest
+
+import evidence_store
+from evidence_store import EvidenceStore, MAINTENANCE_LEASE
+from models import Database
+
+NOW = datetime(2026, 6, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def db(tmp_path):
+    return Database(str(tmp_path / 'test.db'))
+
+
+@pytest.fixture
+def store(db, tmp_path):
+    return EvidenceStore(db, root=str(tmp_path / 'images'))
+
+
+def add_detection(db, store, timestamp, result='Passed'):
+    image_path, image_size = store.save(Image.new('RGB', (64, 48), (200, 30, 30)), timestamp)
+    return db.add_record(result, 0.9, image_path, None, 80, image_size, timestamp)
+
+
+def get_storage(db, record_id):
+    conn = sqlite3.connect(db.db_path)
+    row = conn.execute('SELECT image_path, image_size, storage_state FROM detection_records WHERE id = ?',
+                       (record_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_upgrade_moves_legacy_images_and_backfills_size(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('static/images')
+    with open('static/images/detection_20250102_030405.jpg', 'wb') as f:
+        f.write(b'x' * 100)
+
+    conn = sqlite3.connect('old.db')
+    conn.execute('''
+        CREATE TABLE detection_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, result TEXT NOT NULL,
+            confidence REAL, image_path TEXT, defect_type TEXT, quality_score REAL
+        )
+    ''')
+    conn.executemany('INSERT INTO detection_records (timestamp, result, image_path) VALUES (?, ?, ?)', [
+        ('2025-01-02 03:04:05', '不合格', 'static/images/detection_20250102_030405.jpg'),
+        ('2025-01-03 00:00:00', '合格', 'static/images/gone.jpg'),
+    ])
+    conn.commit()
+    conn.close()
+
+    db = Database('old.db')
+
+    assert get_storage(db, 1) == ('static/images/2025/01/02/detection_20250102_030405.jpg', 100, 'full')
+    assert os.path.exists('static/images/2025/01/02/detection_20250102_030405.jpg')
+    assert get_storage(db, 2)[1:] == (None, 'missing')
+    assert db.get_storage_usage() == {'full': {'count': 1, 'bytes': 100}, 'missing': {'count': 1, 'bytes': 0}}
+
+
+def test_compact_skips_corrupt_and_missing_images(db, store):
+    good = add_detection(db, store, NOW - timedelta(days=2, seconds=3))
+    corrupt = add_detection(db, store, NOW - timedelta(days=2, seconds=2))
+    missing = add_detection(db, store, NOW - timedelta(days=2, seconds=1))
+    with open(get_storage(db, corrupt)[0], 'wb') as f:
+        f.write(b'\xff\xd8truncated')
+    os.remove(get_storage(db, missing)[0])
+
+    assert store.compact(NOW) == 1
+    assert get_storage(db, good)[2] == 'archived'
+    assert get_storage(db, corrupt)[2] == 'corrupt'
+    assert get_storage(db, missing)[2] == 'missing'
+
+
+def test_purge_drops_expired_members_from_shared_archive(db, store):
+    day = datetime(2026, 1, 1, 8)
+    records = [add_detection(db, store, day + timedelta(hours=h)) for h in range(4)]
+    store.compact(day + timedelta(days=2))
+    archive_path = get_storage(db, records[0])[0]
+
+    # Only the first two records are past the 30 day retention
+    assert store.purge_expired(day + timedelta(days=30, hours=1, minutes=30)) == 2
+    with zipfile.ZipFile(archive_path) as archive:
+        assert sorted(archive.namelist()) == sorted(
+            os.path.basename(store.db.get_record_image(r)[2]) for r in records[2:])
+
+    assert store.purge_expired(day + timedelta(days=31)) == 2
+    assert not os.path.exists(archive_path)
+    assert [get_storage(db, r)[2] for r in records] == ['deleted'] * 4
+
+
+def test_failed_remove_leaves_record_for_retry(db, store, monkeypatch):
+    record_id = add_detection(db, store, NOW - timedelta(days=40))
+    image_path = get_storage(db, record_id)[0]
+    real_remove = os.remove
+
+    def locked_remove(path):
+        if path == image_path:
+            raise PermissionError('file is locked')
+        real_remove(path)
+
+    monkeypatch.setattr(evidence_store.os, 'remove', locked_remove)
+    assert store.purge_expired(NOW) == 0
+    assert store.compact(NOW) == 0
+    assert get_storage(db, record_id)[2] == 'full'
+
+    monkeypatch.setattr(evidence_store.os, 'remove', real_remove)
+    assert store.purge_expired(NOW) == 1
+    assert get_storage(db, record_id)[2] == 'deleted'
+    assert not os.path.exists(image_path)
+
+
+def test_maintenance_purges_before_compacting(db, store):
+    expired = [add_detection(db, store, NOW - timedelta(days=40, seconds=i)) for i in range(3)]
+    recent = [add_detection(db, store, NOW - timedelta(days=2, seconds=i)) for i in range(3)]
+
+    assert store.run_maintenance(NOW) == {'purged': 3, 'compacted': 3, 'skipped': False}
+    assert [get_storage(db, r)[2] for r in expired] == ['deleted'] * 3
+    assert [get_storage(db, r)[2] for r in recent] == ['archived'] * 3
+    assert len(glob.glob(f'{store.root}/**/*.zip', recursive=True)) == 1
+
+
+def test_maintenance_skipped_while_another_process_holds_lease(db, store):
+    record_id = add_detection(db, store, NOW - timedelta(days=2))
+    assert db.acquire_lease(MAINTENANCE_LEASE, 'other-worker', 60)
+
+    assert store.run_maintenance(NOW)['skipped'] is True
+    assert get_storage(db, record_id)[2] == 'full'
+
+    db.release_lease(MAINTENANCE_LEASE, 'other-worker')
+    assert store.run_maintenance(NOW)['compacted'] == 1